@@ -0,0 +1,159 @@
+import asyncio
+import numpy as np
+
+from datetime import datetime, date, timedelta
+from typing import Callable, Dict
+from scipy import signal
+
+from db import Database, AnomalyDatabase
+
+
+class Backfill:
+    '''
+        Bulk ingestion of samples buffered by dataHandler during an outage.
+
+        The payload of one machine holds the original messages as rows:
+
+            {'vib':  {'time': [...], 'left': [[...], ...], 'right': [[...], ...]},
+             'temp': {'time': [...], 'values': [[...], ...]}}
+
+        Times are ISO strings or epoch seconds and rows of one channel have the
+        same length. Rows are resampled and averaged by event hour in chunks of
+        chunk_rows, every complete window is scored in batches of inference_batch
+        windows, and hour_avr, day_avr and anomaly rows are written with event
+        times. Nothing is emitted to the monitoring namespace.
+    '''
+    def __init__(self,
+                 model_manager,
+                 sampling_rate: int,
+                 batch_size: int,
+                 thresholds: Dict[str, int],
+                 db_paths: Dict[str, str],
+                 anomaly_data_db_path: str,
+                 inference_batch: int = 64,
+                 chunk_rows: int = 3600,
+                 on_save: Callable[[str, date], None] = None):
+        self.model_manager = model_manager
+        self.sampling_rate = sampling_rate
+        self.batch_size = batch_size
+        self.thresholds = thresholds
+        self.dbs = {name: Database(path) for name, path in db_paths.items()}
+        self.anomaly_data_db = AnomalyDatabase(anomaly_data_db_path)
+        self.inference_batch = inference_batch
+        self.chunk_rows = chunk_rows
+        self.on_save = on_save
+
+    async def ingest(self, name: str, payload: dict) -> dict:
+        model, norm = self.model_manager.model, self.model_manager.norm
+        loop = asyncio.get_running_loop()
+        hour_rows, anomaly_rows, windows = await loop.run_in_executor(None, self.process,
+                                                                      name, payload, model, norm)
+
+        db = self.dbs[name]
+        await db.save_many(hour_rows)
+        await self.anomaly_data_db.save_many(anomaly_rows)
+
+        days = sorted({row[0].date() for row in hour_rows})
+        for day in days:
+            if day < date.today():
+                await db.rebuild_day_avr(day)
+
+        if self.on_save is not None:
+            for day in days:
+                self.on_save('stat_day', day)
+                self.on_save('stat', day)
+            for day in {row[1].date() for row in anomaly_rows}:
+                self.on_save('anomaly', day)
+
+        return {'name': name,
+                'hours': len(hour_rows),
+                'windows': windows,
+                'anomalies': len(anomaly_rows)}
+
+    def process(self, name: str, payload: dict, model, norm):
+        vib = payload.get('vib') or {'time': [], 'left': [], 'right': []}
+        temp = payload.get('temp') or {'time': [], 'values': []}
+
+        vib_time = [_parse_time(value) for value in vib['time']]
+        temp_time = [_parse_time(value) for value in temp['time']]
+
+        left = self.resample_rows(vib['left'])
+        right = self.resample_rows(vib['right'])
+        temp_values = self.resample_rows(temp['values'])
+
+        hour_rows = self.hour_averages(vib_time, vib['left'], vib['right'], temp_time, temp['values'])
+
+        size = min(len(left), len(temp_values)) // self.batch_size * self.batch_size
+        windows = size // self.batch_size
+        anomaly_rows = []
+
+        if windows:
+            batches = np.empty((size, 3), dtype=np.float32)
+            batches[:, 0] = left[:size]
+            batches[:, 1] = right[:size]
+            batches[:, 2] = temp_values[:size]
+            norm.normalize(batches, out=batches)
+            batches = batches.reshape(windows, self.batch_size, 3)
+
+            threshold = self.thresholds[name]
+            for start in range(0, windows, self.inference_batch):
+                scores, _ = model.get_model_res_many(batches[start:start + self.inference_batch])
+
+                for index in np.nonzero(scores >= threshold)[0]:
+                    window = start + index
+                    row = min(((window + 1) * self.batch_size - 1) // self.sampling_rate, len(vib_time) - 1)
+                    anomaly_rows.append((name, vib_time[row], threshold, float(scores[index])))
+
+        return hour_rows, anomaly_rows, windows
+
+    def resample_rows(self, rows) -> np.ndarray:
+        resampled = [signal.resample(chunk, self.sampling_rate, axis=1).astype(np.float32)
+                     for chunk in _chunks(rows, self.chunk_rows)]
+
+        if not resampled:
+            return np.empty(0, dtype=np.float32)
+
+        return np.concatenate(resampled, axis=0).reshape(-1)
+
+    def hour_averages(self, vib_time, left_rows, right_rows, temp_time, temp_rows):
+        # hour rows are stamped at the end of their hour like StatMachine rows
+        vib_hours = [_hour_end(time) for time in vib_time]
+        temp_hours = [_hour_end(time) for time in temp_time]
+        hours = sorted(set(vib_hours) | set(temp_hours))
+        index = {hour: i for i, hour in enumerate(hours)}
+
+        def average(row_hours, rows):
+            sums = np.zeros(len(hours))
+            counts = np.zeros(len(hours))
+            offset = 0
+
+            for chunk in _chunks(rows, self.chunk_rows):
+                keys = [index[hour] for hour in row_hours[offset:offset + len(chunk)]]
+                np.add.at(sums, keys, np.abs(chunk).sum(axis=1))
+                np.add.at(counts, keys, chunk.shape[1])
+                offset += len(chunk)
+
+            return [float(total / count) if count else None for total, count in zip(sums, counts)]
+
+        left = average(vib_hours, left_rows)
+        right = average(vib_hours, right_rows)
+        temp = average(temp_hours, temp_rows)
+
+        return list(zip(hours, left, right, temp))
+
+
+def _chunks(rows, size: int):
+    # rows of one chunk must have the same length (one message each)
+    for start in range(0, len(rows), size):
+        yield np.asarray(rows[start:start + size], dtype=np.float32)
+
+
+def _parse_time(value) -> datetime:
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+
+    return datetime.fromisoformat(value)
+
+
+def _hour_end(time: datetime) -> datetime:
+    return time.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
@@ -0,0 +1,108 @@
+import asyncio
+import tempfile
+import time
+import numpy as np
+import torch
+from configparser import ConfigParser
+
+from normalization import Normalization
+from dataController import ModelMachine
+from model import to_tensor
+from serializer import JsonSerializer, orjson
+
+
+conf = ConfigParser()
+conf.read('resource/config.ini', encoding='utf-8')
+batch_size          = int(conf['model']['batch_size'])
+normalization_path  = conf['norm']['path']
+
+
+def legacy_norm_to_tensor(norm: Normalization, left: list, right: list, temp: list):
+    # per channel arithmetic on list slices, then np.array and np.stack as AeModel used to do
+    norm_left = (left - norm.mean_left) / norm.std_left
+    norm_right = (right - norm.mean_right) / norm.std_right
+    norm_temp = (temp - norm.mean_temp) / norm.std_temp
+    np_arr = np.stack((np.array(norm_left), np.array(norm_right), np.array(norm_temp)), axis=1)
+    return torch.from_numpy(np.reshape(np_arr, (-1, 3, 3))).float()
+
+
+def legacy_step(buffers: list, norm: Normalization, left, right, temp):
+    # list buffers of the former ModelMachine, extended with resampled numpy arrays
+    buffers[0].extend(left)
+    buffers[1].extend(right)
+    buffers[2].extend(temp)
+    tensor = legacy_norm_to_tensor(norm, buffers[0][:batch_size], buffers[1][:batch_size], buffers[2][:batch_size])
+    for buffer in buffers:
+        del buffer[:batch_size]
+
+    return tensor
+
+
+async def bench_norm(number: int = 2000):
+    # ModelMachine.add_vib/add_temp -> trigger -> SampleBuffer.head -> Normalization.norm
+    # -> model.to_tensor, the step AeModel._forward runs before the LSTM
+    norm = Normalization(normalization_path)
+    device = torch.device('cpu')
+    captured = []
+
+    async def callback(batch, name):
+        captured.clear()
+        captured.append(to_tensor(batch, 3, 3, device))
+        return {'anomaly': False}
+
+    machine = ModelMachine('bench', norm, tempfile.mkdtemp() + '/anomaly.db', callback, batch_size)
+
+    rng = np.random.default_rng(0)
+    left, right, temp = (rng.standard_normal(batch_size) for _ in range(3))
+
+    await machine.add_vib(left, right)
+    await machine.add_temp(temp)
+    tensor = captured[0]
+    assert tensor.data_ptr() == machine.batch.ctypes.data, 'tensor does not share the batch buffer'
+
+    expected = legacy_step([[], [], []], norm, left, right, temp)
+    assert torch.allclose(expected, tensor, atol=1e-5), 'normalized tensors differ'
+
+    buffers = [[], [], []]
+    start = time.perf_counter()
+    for _ in range(number):
+        legacy_step(buffers, norm, left, right, temp)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(number):
+        await machine.add_vib(left, right)
+        await machine.add_temp(temp)
+    vectorised = time.perf_counter() - start
+
+    print('samples -> normalise -> tensor (batch ' + str(batch_size) + ', ' + str(number) + ' runs)')
+    print('  legacy       : ' + format(legacy / number * 1e6, '.1f') + ' us/batch')
+    print('  ModelMachine : ' + format(vectorised / number * 1e6, '.1f') + ' us/batch (zero-copy tensor)')
+
+
+def bench_serializer(samples: int = 2000, number: int = 2000):
+    # a relayed 'vib' message (four channels of raw samples) and a 'model' message
+    rng = np.random.default_rng(0)
+    vib = {key: rng.standard_normal(samples).tolist()
+           for key in ('machine1_left', 'machine1_right', 'machine2_left', 'machine2_right')}
+    model = {'name': 'machine1', 'score': np.float64(1234.5), 'remain_time': 12.3,
+             'anomaly': False, 'threshold': 3000, 'model_version': 1}
+
+    backends = ['json'] + (['orjson'] if orjson is not None else [])
+    print('serializer (' + str(samples) + ' samples per vib channel, ' + str(number) + ' runs)')
+
+    for backend in backends:
+        serializer = JsonSerializer(backend)
+        for name, message in (('vib', vib), ('model', model)):
+            start = time.perf_counter()
+            for _ in range(number):
+                serializer.dumps(message, separators=(',', ':'))
+            elapsed = time.perf_counter() - start
+
+            print('  ' + format(backend, '<7') + name + ' : '
+                  + format(number / elapsed, ',.0f') + ' messages/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(bench_norm())
+    bench_serializer()
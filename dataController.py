@@ -1,22 +1,97 @@
-from typing import Callable, List, Awaitable
+import asyncio
+import numpy as np
+import pickle
+
+from typing import Callable, Awaitable
 from clock import TimeController
 from db import Database, AnomalyDatabase
+from ingestQueue import IngestQueue
 from scipy import signal
 from normalization import Normalization
 from datetime import date, timedelta
 
 
+class SampleBuffer:
+    def __init__(self, capacity: int):
+        self.data = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        end = self.size + len(values)
+
+        if end > len(self.data):
+            grown = np.empty(max(end, 2 * len(self.data)), dtype=np.float32)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+
+        self.data[self.size:end] = values
+        self.size = end
+
+    def head(self, size: int) -> np.ndarray:
+        return self.data[:size]
+
+    def consume(self, size: int):
+        remain = self.size - size
+        self.data[:remain] = self.data[size:self.size]
+        self.size = remain
+
+    def trim(self, limit: int) -> int:
+        # keep only the newest limit samples and return how many were dropped
+        dropped = max(self.size - limit, 0)
+        if dropped:
+            self.consume(dropped)
+
+        return dropped
+
+
+class BatchRecorder:
+    '''
+        Records the first count normalized batches seen by the ModelMachines and
+        pickles them to path as a (count, batch_size, 3) float32 array, the
+        format AeModel.set_precision reads as its precision check data.
+    '''
+    def __init__(self, path: str, count: int):
+        self.path = path
+        self.count = count
+        self.batches = []
+
+    @property
+    def done(self) -> bool:
+        return len(self.batches) >= self.count
+
+    def add(self, batch: np.ndarray):
+        if self.done:
+            return
+
+        self.batches.append(batch.copy())
+        if self.done:
+            with open(self.path, "wb") as fw:
+                pickle.dump(np.stack(self.batches), fw)
+
+
 class ModelMachine:
     def __init__(self,
                  name: str,
                  norm: Normalization,
                  db_path: str,
-                 callback: Callable[[List[float], List[float], List[float], str], Awaitable[dict]],
-                 batch_size: int = 10,):
-        self.vib_left = []
-        self.vib_right = []
-        self.temp = []
+                 callback: Callable[[np.ndarray, str], Awaitable[dict]],
+                 batch_size: int = 10,
+                 max_pending: int = None,
+                 on_save: Callable[[str, date], None] = None,
+                 recorder: BatchRecorder = None):
+        self.vib_left = SampleBuffer(2 * batch_size)
+        self.vib_right = SampleBuffer(2 * batch_size)
+        self.temp = SampleBuffer(2 * batch_size)
+        self.batch = np.empty((batch_size, 3), dtype=np.float32)
         self.batch_size = batch_size
+        self.max_pending = max_pending or 10 * batch_size
+        self.dropped = 0
+        self.on_save = on_save
+        self.recorder = recorder
         self.callback = callback
         self.name = name
         self.norm = norm
@@ -26,18 +101,25 @@ class ModelMachine:
         await self.anomaly_data_db.save_now(name=message['name'],
                                             threshold=message['threshold'],
                                             score=message['score'])
+        if self.on_save is not None:
+            self.on_save('anomaly', date.today())
 
     async def trigger(self):
         if self.is_batch():
-            left, right, temp = await self.norm.norm(self.vib_left[:self.batch_size],
-                                                     self.vib_right[:self.batch_size],
-                                                     self.temp[:self.batch_size])
-            message = await self.callback(left, right, temp, self.name)
+            self.batch[:, 0] = self.vib_left.head(self.batch_size)
+            self.batch[:, 1] = self.vib_right.head(self.batch_size)
+            self.batch[:, 2] = self.temp.head(self.batch_size)
+            batch = await self.norm.norm(self.batch, out=self.batch)
+            if self.recorder is not None:
+                self.recorder.add(batch)
 
-            if message['anomaly']:
-                await self.save_anomaly_data(message)
+            try:
+                message = await self.callback(batch, self.name)
 
-            self.clear_batch()
+                if message is not None and message['anomaly']:
+                    await self.save_anomaly_data(message)
+            finally:
+                self.clear_batch()
 
     def is_batch(self):
         return len(self.vib_left) >= self.batch_size \
@@ -45,15 +127,17 @@ class ModelMachine:
             and len(self.vib_right) >= self.batch_size
 
     def clear_batch(self):
-        del self.vib_left[:self.batch_size]
-        del self.vib_right[:self.batch_size]
-        del self.temp[:self.batch_size]
+        self.vib_left.consume(self.batch_size)
+        self.vib_right.consume(self.batch_size)
+        self.temp.consume(self.batch_size)
 
     def add_vib_left(self, data):
         self.vib_left.extend(data)
+        self.dropped += self.vib_left.trim(self.max_pending)
 
     def add_vib_right(self, data):
         self.vib_right.extend(data)
+        self.dropped += self.vib_right.trim(self.max_pending)
 
     async def add_vib(self, left_data, right_data):
         self.add_vib_left(left_data)
@@ -62,12 +146,14 @@ class ModelMachine:
 
     async def add_temp(self, data):
         self.temp.extend(data)
+        self.dropped += self.temp.trim(self.max_pending)
         await self.trigger()
 
 
 class StatMachine:
-    def __init__(self, name, db: Database):
+    def __init__(self, name, db: Database, on_save: Callable[[str, date], None] = None):
         self.name = name
+        self.on_save = on_save
         self.left = Statistics()
         self.right = Statistics()
         self.temp = Statistics()
@@ -75,16 +161,20 @@ class StatMachine:
         self.db = db
 
     async def save_day_avr(self):
+        # delete + insert like Backfill, so a backfill of the same day does not
+        # leave two day_avr rows for it
         last_date = date.today() - timedelta(days=1)
-        time, left, right, temp = await self.db.get_avr_by_one_day(last_date)
-        if time:
-            await self.db.save_day_avr(time, left, right, temp)
+        await self.db.rebuild_day_avr(last_date)
+        if self.on_save is not None:
+            self.on_save('stat', last_date)
 
     async def save_hour_avr(self):
         avr_left = self.left.get_average()
         avr_right = self.right.get_average()
         avr_temp = self.temp.get_average()
         await self.db.save_now(avr_left, avr_right, avr_temp)
+        if self.on_save is not None:
+            self.on_save('stat_day', date.today())
 
     async def trigger(self):
         if self.time.is_day_change():
@@ -125,48 +215,74 @@ class Statistics:
 
 class DataController:
     def __init__(self,
-                 model_req: Callable[[List[float], List[float], List[float]], Awaitable[dict]],
+                 model_req: Callable[[np.ndarray, str], Awaitable[dict]],
                  norm: Normalization,
                  batch_size: int,
                  sampling_rate: int,
                  db_1_path: str,
                  db_2_path: str,
-                 anomaly_data_db_path: str):
+                 anomaly_data_db_path: str,
+                 queue_size: int = 100,
+                 queue_policy: str = 'drop_oldest',
+                 coalesce_limit: int = 10,
+                 max_waiting: int = 100,
+                 logger=None,
+                 on_save: Callable[[str, date], None] = None,
+                 recorder: BatchRecorder = None):
         db1 = Database(db_1_path)
         db2 = Database(db_2_path)
 
-        self.machine1 = ModelMachine('machine1', norm, anomaly_data_db_path, model_req, batch_size)
-        self.machine2 = ModelMachine('machine2', norm, anomaly_data_db_path, model_req, batch_size)
-        self.machine1_stat = StatMachine('machine1', db1)
-        self.machine2_stat = StatMachine('machine2', db2)
+        self.machine1 = ModelMachine('machine1', norm, anomaly_data_db_path, model_req, batch_size,
+                                     on_save=on_save, recorder=recorder)
+        self.machine2 = ModelMachine('machine2', norm, anomaly_data_db_path, model_req, batch_size,
+                                     on_save=on_save, recorder=recorder)
+        self.machine1_stat = StatMachine('machine1', db1, on_save)
+        self.machine2_stat = StatMachine('machine2', db2, on_save)
         self.sampling_rate = sampling_rate
 
-    async def add_vib(self, message: dict):
-        machine1_left = message['machine1_left']
-        machine1_right = message['machine1_right']
-        machine2_left = message['machine2_left']
-        machine2_right = message['machine2_right']
+        self.machine1_queue = IngestQueue('machine1', self.handler(self.machine1, self.machine1_stat),
+                                          queue_size, queue_policy, coalesce_limit, max_waiting, logger)
+        self.machine2_queue = IngestQueue('machine2', self.handler(self.machine2, self.machine2_stat),
+                                          queue_size, queue_policy, coalesce_limit, max_waiting, logger)
 
-        await self.machine1_stat.add_vib(machine1_left, machine1_right)
-        await self.machine2_stat.add_vib(machine2_left, machine2_right)
+    def start(self):
+        self.machine1_queue.start()
+        self.machine2_queue.start()
 
-        machine1_left_resampled = signal.resample(machine1_left, self.sampling_rate)
-        machine1_right_resampled = signal.resample(machine1_right, self.sampling_rate)
-        machine2_left_resampled = signal.resample(machine2_left, self.sampling_rate)
-        machine2_right_resampled = signal.resample(machine2_right, self.sampling_rate)
+    def set_norm(self, norm: Normalization):
+        self.machine1.norm = norm
+        self.machine2.norm = norm
 
-        await self.machine1.add_vib(machine1_left_resampled, machine1_right_resampled)
-        await self.machine2.add_vib(machine2_left_resampled, machine2_right_resampled)
+    def handler(self, machine: ModelMachine, stat: StatMachine):
+        async def process(event: str, channels: tuple, count: int):
+            # a coalesced item holds count messages, each resampled to sampling_rate samples
+            size = self.sampling_rate * count
 
-    async def add_temp(self, message: dict):
-        machine1 = message['machine1']
-        machine2 = message['machine2']
+            if event == 'vib':
+                left, right = channels
+                await stat.add_vib(left, right)
+                await machine.add_vib(signal.resample(left, size), signal.resample(right, size))
+            elif event == 'temp':
+                temp, = channels
+                await stat.add_temp(temp)
+                await machine.add_temp(signal.resample(temp, size))
+
+        return process
 
-        await self.machine1_stat.add_temp(machine1)
-        await self.machine2_stat.add_temp(machine2)
+    async def add_vib(self, message: dict):
+        # machines are enqueued concurrently so a blocked queue does not delay the other
+        await asyncio.gather(self.machine1_queue.put('vib', (message['machine1_left'], message['machine1_right'])),
+                             self.machine2_queue.put('vib', (message['machine2_left'], message['machine2_right'])))
+
+    async def add_temp(self, message: dict):
+        await asyncio.gather(self.machine1_queue.put('temp', (message['machine1'],)),
+                             self.machine2_queue.put('temp', (message['machine2'],)))
 
-        machine1_resampled = signal.resample(machine1, self.sampling_rate)
-        machine2_resampled = signal.resample(machine2, self.sampling_rate)
+    def queue_stats(self) -> dict:
+        machine1 = self.machine1_queue.stats()
+        machine1['dropped_pending'] = self.machine1.dropped
+        machine2 = self.machine2_queue.stats()
+        machine2['dropped_pending'] = self.machine2.dropped
 
-        await self.machine1.add_temp(machine1_resampled)
-        await self.machine2.add_temp(machine2_resampled)
+        return {'machine1': machine1,
+                'machine2': machine2}
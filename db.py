@@ -115,6 +115,17 @@ class Database:
 
         return await self.execute(query)
 
+    def stream(self, table: str, start=None, end=None, chunk_size: int = 1000):
+        # yields chunks of rows from one open cursor, for exports of any size
+        if table not in ('hour_avr', 'day_avr'):
+            raise ValueError('Unknown table: ' + table)
+
+        conditions, params = _date_conditions('time', start, end)
+        yield from _stream(self.path,
+                           'SELECT time, left_vib, right_vib, temperature FROM ' + table
+                           + _where(conditions) + ' ORDER BY time',
+                           params, chunk_size)
+
     async def save_day_avr(self, time, left, right, temp):
         def query(conn):
             cur = conn.cursor()
@@ -123,6 +134,16 @@ class Database:
 
         await self.execute(query)
 
+    async def rebuild_day_avr(self, date):
+        def query(conn):
+            cur = conn.cursor()
+            cur.execute('DELETE FROM day_avr WHERE DATE(time) == ?', (date,))
+            cur.execute('INSERT INTO day_avr(time, left_vib, right_vib, temperature) '
+                        'SELECT DATE(time), AVG(left_vib), AVG(right_vib), AVG(temperature) '
+                        'FROM hour_avr WHERE DATE(time) == ? GROUP BY DATE(time)', (date,))
+
+        await self.execute(query)
+
 
 class AnomalyDatabase:
     def __init__(self, path: str):
@@ -182,6 +203,20 @@ class AnomalyDatabase:
 
         return await self.execute(query)
 
+    def stream(self, name: str = None, start=None, end=None, min_score: float = None, chunk_size: int = 1000):
+        conditions, params = _date_conditions('date', start, end)
+
+        if name is not None:
+            conditions.append('name == ?')
+            params.append(name)
+        if min_score is not None:
+            conditions.append('score >= ?')
+            params.append(min_score)
+
+        yield from _stream(self.path,
+                           'SELECT name, date, threshold, score FROM data' + _where(conditions) + ' ORDER BY date',
+                           params, chunk_size)
+
     async def get_by_one_day(self, date):
         def query(conn):
             conn.row_factory = sqlite3.Row
@@ -202,3 +237,48 @@ class AnomalyDatabase:
 
     async def save_now(self, name: str, threshold: float, score: float):
         await self.save(name, datetime.now(), threshold, score)
+
+    async def save_many(self, datas: List[Tuple[str, datetime, float, float]]):
+        def query(conn):
+            cur = conn.cursor()
+            cur.executemany('INSERT INTO data(name, date, threshold, score) VALUES (?, ?, ?, ?)', datas)
+
+        await self.execute(query)
+
+
+def _date_conditions(column: str, start, end):
+    conditions = []
+    params = []
+
+    if start is not None:
+        conditions.append('DATE(' + column + ') >= ?')
+        params.append(start)
+    if end is not None:
+        conditions.append('DATE(' + column + ') <= ?')
+        params.append(end)
+
+    return conditions, params
+
+
+def _where(conditions: list) -> str:
+    if not conditions:
+        return ''
+
+    return ' WHERE ' + ' and '.join(conditions)
+
+
+def _stream(path: str, sql: str, params: list, chunk_size: int):
+    # StreamingResponse runs each next() in a threadpool worker, which may differ
+    # between chunks. Calls are still sequential, so the connection can be shared.
+    conn = sqlite3.connect(path, check_same_thread=False)
+    try:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
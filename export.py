@@ -0,0 +1,43 @@
+import csv
+import io
+import json
+from typing import Callable, Iterable, Iterator, List
+
+
+STAT_COLUMNS = ['time', 'left_vib', 'right_vib', 'temperature']
+ANOMALY_COLUMNS = ['name', 'date', 'threshold', 'score']
+MEDIA_TYPES = {'ndjson': 'application/x-ndjson',
+               'csv': 'text/csv'}
+
+
+def to_ndjson(columns: List[str], chunks: Iterable[list],
+              dumps: Callable[[dict], str] = None) -> Iterator[bytes]:
+    if dumps is None:
+        def dumps(row):
+            return json.dumps(row, default=str)
+
+    for rows in chunks:
+        yield ''.join(dumps(dict(zip(columns, row))) + '\n' for row in rows).encode('utf-8')
+
+
+def to_csv(columns: List[str], chunks: Iterable[list]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def encode(fmt: str, columns: List[str], chunks: Iterable[list],
+           dumps: Callable[[dict], str] = None) -> Iterator[bytes]:
+    if fmt == 'csv':
+        return to_csv(columns, chunks)
+
+    return to_ndjson(columns, chunks, dumps)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import time
+import numpy as np
+
+from collections import deque
+from typing import Callable, Awaitable
+
+
+POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+
+class IngestQueue:
+    '''
+        Bounded queue of ('vib' | 'temp', channels) items for one machine,
+        consumed by its own worker task so a slow or failing machine does not
+        hold up the others.
+
+        block       : put waits until the worker frees a slot; at most max_waiting
+                      puts wait at a time (socket.io runs every event in its own
+                      task), further messages are dropped
+        drop_oldest : the oldest queued item is dropped to make room
+        coalesce    : samples are appended to the newest queued item of the same
+                      event (at most coalesce_limit messages per item), otherwise
+                      the oldest item is dropped
+    '''
+    def __init__(self,
+                 name: str,
+                 handler: Callable[[str, tuple, int], Awaitable[None]],
+                 maxsize: int = 100,
+                 policy: str = 'drop_oldest',
+                 coalesce_limit: int = 10,
+                 max_waiting: int = 100,
+                 logger: logging.Logger = None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy: ' + policy)
+
+        self.name = name
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.coalesce_limit = coalesce_limit
+        self.max_waiting = max_waiting
+        self.logger = logger
+
+        self.items = deque()
+        self.not_empty = None
+        self.not_full = None
+        self.task = None
+        self.waiting = 0
+
+        self.processed = 0
+        self.errors = 0
+        self.coalesced = 0
+        self.dropped_items = 0
+        self.dropped_samples = 0
+
+    def start(self):
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def put(self, event: str, channels: tuple):
+        item = [event, channels, 1]
+
+        if len(self.items) >= self.maxsize:
+            if self.policy == 'block':
+                if self.waiting >= self.max_waiting:
+                    self._drop(item)
+                    return
+
+                self.waiting += 1
+                try:
+                    while len(self.items) >= self.maxsize:
+                        self.not_full.clear()
+                        await self.not_full.wait()
+                finally:
+                    self.waiting -= 1
+            elif self.policy == 'coalesce' and self._coalesce(item):
+                return
+            else:
+                self._drop_oldest()
+
+        self.items.append(item)
+        self.not_empty.set()
+
+    def _coalesce(self, item: list) -> bool:
+        for queued in reversed(self.items):
+            if queued[0] != item[0]:
+                continue
+
+            if queued[2] >= self.coalesce_limit:
+                return False
+
+            queued[1] = tuple(np.concatenate((old, new)) for old, new in zip(queued[1], item[1]))
+            queued[2] += 1
+            self.coalesced += 1
+            return True
+
+        return False
+
+    def _drop_oldest(self):
+        self._drop(self.items.popleft())
+
+    def _drop(self, item: list):
+        _, channels, _ = item
+        self.dropped_items += 1
+        self.dropped_samples += sum(len(channel) for channel in channels)
+
+    async def run(self):
+        while True:
+            while not self.items:
+                self.not_empty.clear()
+                await self.not_empty.wait()
+
+            event, channels, count = self.items.popleft()
+            self.not_full.set()
+
+            try:
+                start = time.perf_counter()
+                await self.handler(event, channels, count)
+                self.processed += 1
+
+                if self.logger is not None and self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(self.name + ' ' + event + ' processed',
+                                      extra={'timing': {'machine': self.name,
+                                                        'event': event,
+                                                        'messages': count,
+                                                        'seconds': time.perf_counter() - start,
+                                                        'depth': len(self.items)}})
+            except Exception as error:
+                self.errors += 1
+                print(self.name + ' ' + event + ': ' + str(error))
+
+    def stats(self) -> dict:
+        return {'depth': len(self.items),
+                'maxsize': self.maxsize,
+                'waiting': self.waiting,
+                'policy': self.policy,
+                'processed': self.processed,
+                'errors': self.errors,
+                'coalesced': self.coalesced,
+                'dropped_items': self.dropped_items,
+                'dropped_samples': self.dropped_samples}
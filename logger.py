@@ -1,9 +1,14 @@
+import atexit
+import json
 import logging.handlers
 import os
+import queue
 
 
 class LoggerFactory:
     logger = None
+    queue_handler = None
+    listener = None
 
     @staticmethod
     def get_logger():
@@ -17,24 +22,88 @@ class LoggerFactory:
     def init_logger(name: str = 'log',
                     log_level: any = logging.INFO,
                     save_file: bool = False,
-                    save_path: str = None):
+                    save_path: str = None,
+                    use_queue: bool = False,
+                    queue_size: int = 10000,
+                    json_format: bool = False):
+        '''
+            use_queue   : Records are put on a bounded queue and formatted and written
+                          by a QueueListener thread. Records are dropped (and counted)
+                          when the queue is full instead of blocking the caller.
+
+            json_format : Write one JSON object per line. A dict passed as
+                          extra={'timing': {...}} is kept as a nested object.
+        '''
         _init_path(save_path)
 
         if LoggerFactory.logger is None:
             LoggerFactory.logger = logging.getLogger(name)
             LoggerFactory.logger.setLevel(log_level)
 
-            formatter = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s : %(message)s')
+            if json_format:
+                formatter = _JsonFormatter()
+            else:
+                formatter = logging.Formatter('%(asctime)s | %(name)s | %(levelname)s : %(message)s')
 
-            stream_handler = _get_stream_handler(formatter)
-            LoggerFactory.logger.addHandler(stream_handler)
+            handlers = [_get_stream_handler(formatter)]
 
             if save_file:
-                file_handler = _get_file_handler(save_path, name, formatter)
-                LoggerFactory.logger.addHandler(file_handler)
+                handlers.append(_get_file_handler(save_path, name, formatter))
+
+            if use_queue:
+                LoggerFactory.queue_handler = _DroppingQueueHandler(queue.Queue(queue_size))
+                LoggerFactory.listener = logging.handlers.QueueListener(LoggerFactory.queue_handler.queue,
+                                                                        *handlers,
+                                                                        respect_handler_level=True)
+                LoggerFactory.listener.start()
+                atexit.register(LoggerFactory.listener.stop)
+                LoggerFactory.logger.addHandler(LoggerFactory.queue_handler)
+            else:
+                for handler in handlers:
+                    LoggerFactory.logger.addHandler(handler)
         else:
             print('Logger already exists.')
 
+    @staticmethod
+    def get_dropped() -> int:
+        if LoggerFactory.queue_handler is None:
+            return 0
+
+        return LoggerFactory.queue_handler.dropped
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {'time': self.formatTime(record),
+                'name': record.name,
+                'level': record.levelname,
+                'message': record.getMessage()}
+
+        timing = getattr(record, 'timing', None)
+        if timing is not None:
+            data['timing'] = timing
+
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
+
 
 def _get_file_handler(path: str, name: str, formatter):
     file_path = path + '/' + name
@@ -54,4 +123,4 @@ def _get_stream_handler(formatter):
 
 def _init_path(path: str):
     if not os.path.exists(path):
-        os.makedirs(path)
\ No newline at end of file
+        os.makedirs(path)
@@ -3,9 +3,18 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 import numpy as np
-from typing import List
 import easydict
 import pickle
+import os
+
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+
+def to_tensor(batch: np.ndarray, window_size: int, input_size: int, device: torch.device) -> torch.Tensor:
+    # float32 batches are wrapped without a copy on cpu
+    reshaped = np.reshape(batch, (-1, window_size, input_size))
+    return torch.from_numpy(reshaped).float().to(device)
 
 
 class Encoder(nn.Module):
@@ -106,9 +115,20 @@ class AnomalyCalculator:
         x = (recons_error - self.mean)
         return np.matmul(np.matmul(x, self.std), x.T)
 
+    def mean_scores(self, recons_errors: np.array):
+        # mean of x S x^T over all pairs of a window equals x_mean S x_mean^T,
+        # so (windows, n, 3) errors give the same scores as __call__(...).mean() per window
+        x = recons_errors.mean(axis=1) - self.mean
+        return np.einsum('wi,ij,wj->w', x, self.std, x)
+
 
 class AeModel:
-    def __init__(self, model_prt_path: str, calc_path: str):
+    def __init__(self,
+                 model_prt_path: str,
+                 calc_path: str,
+                 precision: str = 'fp32',
+                 check_path: str = None,
+                 tolerance: float = 0.01):
         self.args = easydict.EasyDict({
             "batch_size": 128,
             "device": torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu'),
@@ -131,26 +151,91 @@ class AeModel:
             init_data = pickle.load(fr)
         self.anomaly_calculator = AnomalyCalculator(init_data['mean'], init_data['std'])
 
-    async def inference_model(self, left: List[float], right: List[float], temp: List[float]):
-        np_left = np.array(left)
-        np_right = np.array(right)
-        np_temp = np.array(temp)
-        np_arr = np.stack((np_left, np_right, np_temp), axis=1)
-        reshaped = np.reshape(np_arr, (128, 3, 3))
-        data = torch.from_numpy(reshaped).float()
-        res = self.model(data.to(self.args.device))
-        return res
+        self.precision = 'fp32'
+        if precision != 'fp32':
+            self.set_precision(precision, check_path, tolerance)
+
+    def set_precision(self, precision: str, check_path: str, tolerance: float) -> bool:
+        '''
+            Switch inference to bf16 autocast or dynamic int8 quantization.
+
+            check_path is a pickled array of recorded, normalized batches shaped
+            (num_batches, batch_size, 3) with columns (left, right, temp). The mode
+            is only enabled if the relative score drift against fp32 on every
+            batch stays within tolerance, otherwise fp32 is kept.
+        '''
+        if precision not in PRECISIONS:
+            print('Unknown precision mode: ' + precision)
+            return False
+
+        if precision == 'int8' and self.args.device.type != 'cpu':
+            print('int8 quantization is only supported on cpu, keep fp32.')
+            return False
+
+        if not check_path or not os.path.exists(check_path):
+            print('Precision check data does not exist, keep fp32.')
+            return False
+
+        with open(check_path, "rb") as fr:
+            batches = pickle.load(fr)
+
+        if precision == 'int8':
+            model = torch.ao.quantization.quantize_dynamic(self.model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+        else:
+            model = self.model
+
+        drift = 0.0
+        for batch in batches:
+            expected = self._score(self._forward(self.model, 'fp32', batch))
+            actual = self._score(self._forward(model, precision, batch))
+            drift = max(drift, abs(actual - expected) / max(abs(expected), 1e-12))
+
+        if drift > tolerance:
+            print('Score drift of ' + precision + ' is ' + str(drift) + ' (tolerance: ' + str(tolerance) + '), keep fp32.')
+            return False
+
+        self.model = model
+        self.precision = precision
+        return True
+
+    def _forward(self, model, precision: str, batch: np.ndarray):
+        data = to_tensor(batch, self.args.window_size, self.args.input_size, self.args.device)
 
-    async def get_score(self, predict_values):
-        loss_list = []
+        with torch.no_grad():
+            if precision == 'bf16':
+                with torch.autocast(device_type=self.args.device.type, dtype=torch.bfloat16):
+                    recons, src = model(data)
+                return [recons.float(), src]
+
+            return model(data)
+
+    def _score(self, predict_values):
         with torch.no_grad():
             loss = F.l1_loss(predict_values[0], predict_values[1], reduction='none')
             loss = loss.mean(dim=1).cpu().numpy()
-            loss_list.append(loss)
 
-        loss_list = np.concatenate(loss_list, axis=0)
-        ans_score = self.anomaly_calculator(loss_list).mean()
-        return ans_score
+        return self.anomaly_calculator(loss).mean()
+
+    def score(self, batch: np.ndarray):
+        return self._score(self._forward(self.model, self.precision, batch))
+
+    def scores(self, batches: np.ndarray) -> np.ndarray:
+        # (windows, batch_size, 3) -> one score per window in a single forward pass
+        windows = batches.shape[0]
+        recons, src = self._forward(self.model, self.precision, batches)
+
+        with torch.no_grad():
+            loss = F.l1_loss(recons, src, reduction='none')
+            loss = loss.mean(dim=1).cpu().numpy()
+
+        return self.anomaly_calculator.mean_scores(loss.reshape(windows, -1, loss.shape[-1]))
+
+    async def inference_model(self, batch: np.ndarray):
+        res = self._forward(self.model, self.precision, batch)
+        return res
+
+    async def get_score(self, predict_values):
+        return self._score(predict_values)
 
 
 class RegressionModel(nn.Module):
@@ -176,13 +261,28 @@ class Regression:
 
 
 class Model:
-    def __init__(self, ae_model_path, calc_data_path, reg_model_path):
-        self.ae_model = AeModel(ae_model_path, calc_data_path)
+    def __init__(self, ae_model_path, calc_data_path, reg_model_path,
+                 precision: str = 'fp32', precision_check_path: str = None, precision_tolerance: float = 0.01):
+        self.ae_model = AeModel(ae_model_path, calc_data_path,
+                                precision, precision_check_path, precision_tolerance)
         self.reg_model = Regression(reg_model_path)
 
-    async def get_model_res(self, left: List[float], right: List[float], temp: List[float]):
-        model_res = await self.ae_model.inference_model(left, right, temp)
+    async def get_model_res(self, batch: np.ndarray):
+        model_res = await self.ae_model.inference_model(batch)
         score = await self.ae_model.get_score(model_res)
         time = await self.reg_model.get_time(score)
 
         return score, time.item()
+
+    def get_model_res_many(self, batches: np.ndarray):
+        scores = self.ae_model.scores(batches)
+        with torch.no_grad():
+            times = self.reg_model.model(torch.from_numpy(scores).float().unsqueeze(1))
+
+        return scores, times.squeeze(1).cpu().numpy()
+
+    def warm_up(self, batch_size: int):
+        batch = np.zeros((batch_size, self.ae_model.args.input_size), dtype=np.float32)
+        score = self.ae_model.score(batch)
+        with torch.no_grad():
+            self.reg_model.model(torch.Tensor([score]))
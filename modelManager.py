@@ -0,0 +1,109 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+
+
+class ModelManager:
+    '''
+        Owns the Model and Normalization used by model_req. A reload builds and
+        warms up a new pair in an executor thread and swaps both at once, so
+        samples buffered in every ModelMachine are kept.
+    '''
+    def __init__(self,
+                 model_path: str,
+                 init_data_path: str,
+                 reg_model_path: str,
+                 normalization_path: str,
+                 batch_size: int,
+                 precision: str = 'fp32',
+                 precision_check_path: str = None,
+                 precision_tolerance: float = 0.01,
+                 logger=None):
+        self.model_path = model_path
+        self.init_data_path = init_data_path
+        self.reg_model_path = reg_model_path
+        self.normalization_path = normalization_path
+        self.batch_size = batch_size
+        self.precision = precision
+        self.precision_check_path = precision_check_path
+        self.precision_tolerance = precision_tolerance
+        self.logger = logger
+
+        self.model = None
+        self.norm = None
+        self.version = 0
+        self.loaded_at = None
+        self.timings = {}
+        self.on_swap = None
+        self._mtimes = None
+        self._lock = asyncio.Lock()
+
+    def artifacts(self):
+        return [self.model_path, self.init_data_path, self.reg_model_path, self.normalization_path]
+
+    def get_mtimes(self):
+        return tuple(os.path.getmtime(path) if os.path.exists(path) else None
+                     for path in self.artifacts())
+
+    def load(self):
+        timings = {}
+
+        start = time.perf_counter()
+        from model import Model
+        from normalization import Normalization
+        timings['import_model'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        model = Model(self.model_path, self.init_data_path, self.reg_model_path,
+                      self.precision, self.precision_check_path, self.precision_tolerance)
+        timings['load_model'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        norm = Normalization(self.normalization_path)
+        timings['load_normalization'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        model.warm_up(self.batch_size)
+        timings['warm_up'] = time.perf_counter() - start
+
+        self.timings = timings
+        return model, norm
+
+    async def reload(self) -> int:
+        async with self._lock:
+            mtimes = self.get_mtimes()
+            loop = asyncio.get_running_loop()
+            model, norm = await loop.run_in_executor(None, self.load)
+            self.swap(model, norm, mtimes)
+
+            return self.version
+
+    def swap(self, model, norm, mtimes=None):
+        self.model = model
+        self.norm = norm
+        self.version += 1
+        self.loaded_at = datetime.now()
+        self._mtimes = mtimes
+
+        if self.on_swap is not None:
+            self.on_swap(model, norm)
+
+        if self.logger is not None:
+            self.logger.info('model version ' + str(self.version) + ' loaded')
+
+    async def watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+
+            mtimes = self.get_mtimes()
+            if mtimes != self._mtimes:
+                try:
+                    await self.reload()
+                except Exception as error:
+                    self._mtimes = mtimes
+                    print(error)
+
+    def status(self) -> dict:
+        return {'version': self.version,
+                'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None}
@@ -1,8 +1,5 @@
 import pickle
-
-
-async def norm(data, mean, std):
-    return (data - mean) / std
+import numpy as np
 
 
 class Normalization:
@@ -19,10 +16,22 @@ class Normalization:
             self.std_left = std[1]
             self.std_right = std[2]
 
-    async def norm(self, left, right, temp):
-        norm_left = await norm(left, self.mean_left, self.std_left)
-        norm_right = await norm(right, self.mean_right, self.std_right)
-        norm_temp = await norm(temp, self.mean_temp, self.std_temp)
+        # column order of a stacked batch: (left, right, temp)
+        self.mean = np.array([self.mean_left, self.mean_right, self.mean_temp], dtype=np.float32)
+        self.std = np.array([self.std_left, self.std_right, self.std_temp], dtype=np.float32)
+
+    async def norm(self, data: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        '''
+            Normalize an (n, 3) batch. Pass out (which may be data itself) to
+            write the result into a reusable float32 buffer instead of allocating.
+        '''
+        return self.normalize(data, out)
+
+    def normalize(self, data: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        if out is None:
+            out = np.empty(data.shape, dtype=np.float32)
 
-        return norm_left, norm_right, norm_temp
+        np.subtract(data, self.mean, out=out)
+        np.divide(out, self.std, out=out)
 
+        return out
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    '''
+        Samples the stacks of all other threads from sys._current_frames() every
+        interval seconds and aggregates them in collapsed-stack format
+        ("thread;outer;...;inner count"), which flamegraph.pl and speedscope read.
+    '''
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(code.co_name + ' (' + os.path.basename(code.co_filename)
+                             + ':' + str(code.co_firstlineno) + ')')
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+
+            self.stacks[';'.join(reversed(stack))] += 1
+
+        self.samples += 1
+
+    def collapsed(self) -> str:
+        return '\n'.join(stack + ' ' + str(count) for stack, count in self.stacks.most_common())
+
+
+async def profile(seconds: float, interval: float = 0.005) -> str:
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+
+    return profiler.collapsed()
+
+
+_original_run = None
+_ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+
+class _Watchdog:
+    '''
+        Shared state of the patched Handle._run and the watchdog thread. The
+        loop thread only stores the start of each step; the watchdog reads its
+        stack when a step has run for threshold seconds.
+    '''
+    def __init__(self, threshold: float, logger):
+        self.threshold = threshold
+        self.logger = logger
+        self.loop_thread = None
+        self.started = None
+        self.step = 0
+        self.reported = 0
+        self.run_code = None
+        self.thread = threading.Thread(target=self._run, name='slow-callback-watchdog', daemon=True)
+
+    def _run(self):
+        interval = self.threshold / 2
+
+        while True:
+            time.sleep(interval)
+
+            started, step = self.started, self.step
+            if started is None or step == self.reported:
+                continue
+
+            elapsed = time.perf_counter() - started
+            if elapsed < self.threshold:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None or self.step != step:
+                continue
+
+            self.reported = step
+            self.logger.warning('slow callback running for ' + format(elapsed, '.3f')
+                                + 's in ' + _describe(frame, self.run_code))
+
+
+_watchdog = None
+
+
+def install_slow_callback_detector(threshold: float, logger):
+    '''
+        Log event loop steps that run longer than threshold seconds with the
+        stack the loop thread is blocked in (e.g. process > ModelMachine.trigger
+        > Model.get_model_res), taken by a watchdog thread while the step is
+        still running. The patched Handle._run only stores when each step
+        started, so nothing is walked on the loop thread.
+
+        loop.set_debug(True) with slow_callback_duration is not used because
+        debug mode records a traceback for every scheduled callback, which is
+        too costly for production, and only names the callback after it
+        returned. Patching Handle._run only covers the pure asyncio event loop,
+        not uvloop.
+    '''
+    global _original_run, _watchdog
+
+    if _original_run is not None:
+        return
+
+    _original_run = asyncio.events.Handle._run
+    _watchdog = watchdog = _Watchdog(threshold, logger)
+
+    def _run(handle):
+        watchdog.loop_thread = threading.get_ident()
+        watchdog.step += 1
+        watchdog.started = time.perf_counter()
+        try:
+            _original_run(handle)
+        finally:
+            watchdog.started = None
+
+    watchdog.run_code = _run.__code__
+    asyncio.events.Handle._run = _run
+    watchdog.thread.start()
+
+
+def _describe(frame, run_code) -> str:
+    # the frames of the running step from outermost to innermost, without the
+    # event loop and asyncio internals
+    names = []
+    while frame is not None and frame.f_code is not run_code:
+        code = frame.f_code
+        if not code.co_filename.startswith(_ASYNCIO_DIR):
+            names.append(getattr(code, 'co_qualname', code.co_name))
+        frame = frame.f_back
+
+    return ' > '.join(reversed(names))
@@ -1,20 +1,32 @@
+import time
+_import_start = time.perf_counter()
+
 import asyncio
+import hmac
+import os
 import socketio
 import datetime
 
 from asyncio import AbstractEventLoop
 from uvicorn import Config, Server
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from configparser import ConfigParser
-from typing import List
 
-from model import Model
 from db import Database, AnomalyDatabase
 from customNamespace import MachineHandler, CustomNamespace
-from dataController import DataController
-from normalization import Normalization
 from logger import LoggerFactory
+from startup import StartupTracker
+from modelManager import ModelManager
+from responseCache import ResponseCache, cached_response
+from profiler import profile, install_slow_callback_detector
+from serializer import JsonSerializer, response_class
+import export
+
+_import_time = time.perf_counter() - _import_start
+_config_start = time.perf_counter()
 
 
 conf = ConfigParser()
@@ -26,6 +38,11 @@ model_sampling_rate     = int(conf['model']['rate'])
 model_batch_size        = int(conf['model']['batch_size'])
 threshold_machine1      = int(conf['model']['threshold_machine1'])
 threshold_machine2      = int(conf['model']['threshold_machine2'])
+precision               = conf['model']['precision']
+precision_check_path    = conf['model']['precision_check']
+precision_tolerance     = float(conf['model']['precision_tolerance'])
+precision_record        = int(conf['model']['precision_record'])
+model_watch_interval    = float(conf['model']['watch_interval'])
 
 db_1_path               = conf['database']['machine1']
 db_2_path               = conf['database']['machine2']
@@ -35,12 +52,35 @@ origins                 = conf['server']['origins'].split(',')
 send_sampling_rate      = int(conf['server']['sampling_rate'])
 ping_interval           = int(conf['server']['ping_interval'])
 ping_timeout            = int(conf['server']['ping_timeout'])
+lazy_startup            = conf['server'].getboolean('lazy_startup')
+startup_buffer_size     = int(conf['server']['startup_buffer'])
+serializer_backend      = conf['server']['serializer']
 
 machine_namespace       = conf['namespace']['machine']
 monitoring_namespace    = conf['namespace']['monitoring']
 
 normalization_path      = conf['norm']['path']
 log_path                = conf['log']['directory']
+log_level               = conf['log']['level']
+log_queue               = conf['log'].getboolean('queue')
+log_queue_size          = int(conf['log']['queue_size'])
+log_json                = conf['log'].getboolean('json')
+admin_token             = conf['admin']['token']
+
+ingest_queue_size       = int(conf['ingest']['queue_size'])
+ingest_policy           = conf['ingest']['policy']
+ingest_coalesce_limit   = int(conf['ingest']['coalesce_limit'])
+ingest_max_waiting      = int(conf['ingest']['max_waiting'])
+
+cache_size              = int(conf['cache']['size'])
+cache_ttl               = float(conf['cache']['ttl'])
+
+slow_callback_threshold = float(conf['profile']['slow_callback'])
+profile_max_seconds     = float(conf['profile']['max_seconds'])
+
+backfill_inference_batch = int(conf['backfill']['inference_batch'])
+backfill_chunk_rows     = int(conf['backfill']['chunk_rows'])
+export_chunk_size       = int(conf['export']['chunk_size'])
 
 
 ''' 
@@ -48,21 +88,68 @@ log_path                = conf['log']['directory']
 
     socket_logger   : Process socket connection logs. To save the log file, set 
                       the argument save_file to True and set save_path to the desired 
-                      directory path.
+                      directory path. With [log] queue the formatting and I/O run in 
+                      a listener thread, json writes JSON lines and level = DEBUG adds 
+                      per-item ingestion timing records.
 
     dc              : An object that performs all processing on data
 
     machine_handler : Customized AsyncNamespace of dataHandler program. It can receive 
                       'vib', 'temp' event and hand over to callable instance(callback)
+
+    startup         : Startup phase timings and readiness. With lazy_startup the socket 
+                      is bound first and 'vib', 'temp' events are buffered until the 
+                      model and dc are loaded in the background.
+
+    model_manager   : Holds the Model and Normalization in use. POST /admin/model/reload 
+                      or a change of the model files (watch_interval > 0) loads a new 
+                      pair in the background and swaps it without dropping samples.
+
+    dc ingestion    : Every machine has a bounded queue processed by its own worker. When 
+                      it is full, [ingest] policy decides between block, drop_oldest and 
+                      coalesce. Under block at most max_waiting messages per machine 
+                      wait for a slot and later ones are dropped. Depth and drop 
+                      counters are served at GET /ingest.
+
+    response_cache  : Results of /stat and /anomaly keyed by route and dates. Closed 
+                      periods are kept until evicted, periods including today expire 
+                      after [cache] ttl or when dc writes a row for one of their dates.
+
+    profiling       : GET /admin/profile samples all threads for N seconds and returns 
+                      collapsed stacks for a flamegraph. With [profile] slow_callback > 0 
+                      a watchdog thread logs the stack of every event loop step that 
+                      runs longer than it.
+
+    backfill        : POST /backfill/{name} takes the messages dataHandler buffered during 
+                      an outage, scores them in large batches and stores stats and 
+                      anomalies with their event times without emitting realtime events.
+
+    export          : GET /export/stat/{name} and /export/anomaly stream filtered rows 
+                      as NDJSON or CSV, fetching [export] chunk_size rows at a time.
+
+    serializer      : JSON encoder shared by socket.io emits, HTTP responses, the 
+                      response cache and NDJSON exports. [server] serializer = auto 
+                      uses orjson when it is installed.
 '''
 
 
-model = Model(model_path, init_data_path, reg_model_path)
+startup = StartupTracker(startup_buffer_size)
+_config_time = time.perf_counter() - _config_start
+
+model_manager = ModelManager(model_path, init_data_path, reg_model_path, normalization_path,
+                             model_batch_size, precision, precision_check_path, precision_tolerance)
+dc = None
+backfill = None
+profile_lock = asyncio.Lock()
+serializer = JsonSerializer(serializer_backend)
+response_cache = ResponseCache(lambda result: serializer.dumps_bytes(jsonable_encoder(result)),
+                               cache_size, cache_ttl)
 sio = socketio.AsyncServer(async_mode='asgi',
                            cors_allowed_origins='*',
                            ping_interval=ping_interval,
-                           ping_timeout=ping_timeout,)
-app = FastAPI()
+                           ping_timeout=ping_timeout,
+                           json=serializer,)
+app = FastAPI(default_response_class=response_class(serializer))
 app.add_middleware(CORSMiddleware,
                    allow_origins=origins,
                    allow_credentials=True,
@@ -78,9 +165,16 @@ def server_load(_app, _config: ConfigParser, loop: AbstractEventLoop):
     return Server(config)
 
 
-async def model_req(left: List[float], right: List[float], temp: List[float], name: str) -> dict:
+def require_admin(x_admin_token: str = Header(None)):
+    if not admin_token or x_admin_token is None \
+            or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail='admin token required')
+
+
+async def model_req(batch, name: str) -> dict:
     try:
-        score, exp_time = await model.get_model_res(left, right, temp)
+        model, version = model_manager.model, model_manager.version
+        score, exp_time = await model.get_model_res(batch)
 
         if name == 'machine1':
             threshold = threshold_machine1
@@ -93,7 +187,8 @@ async def model_req(left: List[float], right: List[float], temp: List[float], na
             'score': score,
             'remain_time': exp_time,
             'anomaly': bool(anomaly),
-            'threshold': threshold
+            'threshold': threshold,
+            'model_version': version
         }
         await sio.emit('model', message, namespace=monitoring_namespace)
 
@@ -103,13 +198,88 @@ async def model_req(left: List[float], right: List[float], temp: List[float], na
 
 
 LoggerFactory.init_logger(name='socket_log',
+                          log_level=log_level,
                           save_file=True,
-                          save_path=log_path)
+                          save_path=log_path,
+                          use_queue=log_queue,
+                          queue_size=log_queue_size,
+                          json_format=log_json)
 
 socket_logger = LoggerFactory.get_logger()
-dc = DataController(model_req, Normalization(normalization_path),
-                    model_batch_size, model_sampling_rate,
-                    db_1_path, db_2_path, anomaly_data_db_path)
+startup.set_logger(socket_logger)
+model_manager.logger = socket_logger
+startup.record('import', _import_time)
+startup.record('config', _config_time)
+
+
+def load_data_controller():
+    from dataController import DataController, BatchRecorder
+
+    recorder = None
+    if precision_check_path and precision_record > 0 and not os.path.exists(precision_check_path):
+        recorder = BatchRecorder(precision_check_path, precision_record)
+
+    return DataController(model_req, model_manager.norm,
+                          model_batch_size, model_sampling_rate,
+                          db_1_path, db_2_path, anomaly_data_db_path,
+                          ingest_queue_size, ingest_policy, ingest_coalesce_limit,
+                          ingest_max_waiting, socket_logger, response_cache.invalidate, recorder)
+
+
+def load_backfill():
+    from backfill import Backfill
+
+    return Backfill(model_manager, model_sampling_rate, model_batch_size,
+                    {'machine1': threshold_machine1, 'machine2': threshold_machine2},
+                    {'machine1': db_1_path, 'machine2': db_2_path},
+                    anomaly_data_db_path,
+                    backfill_inference_batch, backfill_chunk_rows,
+                    response_cache.invalidate)
+
+
+def on_model_swap(_, norm):
+    if dc is not None:
+        dc.set_norm(norm)
+
+
+model_manager.on_swap = on_model_swap
+
+
+async def start_components():
+    global dc, backfill
+
+    try:
+        loop = asyncio.get_running_loop()
+        await model_manager.reload()
+        for name, seconds in model_manager.timings.items():
+            startup.record(name, seconds)
+
+        with startup.phase('init_data_controller'):
+            dc = await loop.run_in_executor(None, load_data_controller)
+            dc.set_norm(model_manager.norm)
+            dc.start()
+            backfill = await loop.run_in_executor(None, load_backfill)
+
+        with startup.phase('replay_buffer'):
+            await startup.drain(add_data_by_event)
+
+        if model_watch_interval > 0:
+            loop.create_task(model_manager.watch(model_watch_interval))
+    except Exception as error:
+        startup.fail(error)
+        socket_logger.error('startup failed: ' + str(error), exc_info=True)
+
+        # without lazy startup a broken model or normalization path must stop the
+        # server, otherwise every event would end up in the startup buffer
+        if not lazy_startup:
+            raise
+
+
+async def record_bind(server: Server):
+    start = time.perf_counter()
+    while not server.started:
+        await asyncio.sleep(0.01)
+    startup.record('bind', time.perf_counter() - start)
 
 
 async def add_data_by_event(event, message):
@@ -120,7 +290,10 @@ async def add_data_by_event(event, message):
 
 
 async def event_handling(event, message):
-    await add_data_by_event(event, message)
+    if startup.ready:
+        await add_data_by_event(event, message)
+    else:
+        startup.buffer_event(event, message)
     await sio.emit(event, message, namespace=monitoring_namespace)
 
 
@@ -135,43 +308,147 @@ sio.register_namespace(namespace_handler=machine_handler)
 sio.register_namespace(namespace_handler=monitoring)
 
 
+@app.get("/ready")
+async def get_ready():
+    status_code = 200 if startup.ready else 503
+    return JSONResponse(status_code=status_code, content=startup.status())
+
+
+@app.post("/admin/model/reload", dependencies=[Depends(require_admin)])
+async def reload_model():
+    try:
+        await model_manager.reload()
+
+        return model_manager.status()
+    except Exception as error:
+        print(error)
+        raise HTTPException(status_code=500, detail=str(error))
+
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+async def get_profile(seconds: float = 10, interval: float = 0.005):
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail='profiler already running')
+
+    async with profile_lock:
+        stacks = await profile(min(seconds, profile_max_seconds), max(interval, 0.001))
+
+    return PlainTextResponse(stacks)
+
+
+@app.post("/backfill/{name}")
+async def post_backfill(name: str, payload: dict):
+    if backfill is None:
+        raise HTTPException(status_code=503, detail='server is starting')
+
+    if name not in backfill.thresholds:
+        raise HTTPException(status_code=404, detail='unknown machine: ' + name)
+
+    try:
+        return await backfill.ingest(name, payload)
+    except Exception as error:
+        print(error)
+        raise HTTPException(status_code=400, detail=str(error))
+
+
+@app.get("/ingest")
+async def get_ingest_stats():
+    stats = {} if dc is None else dc.queue_stats()
+    stats['log_dropped'] = LoggerFactory.get_dropped()
+    stats['cache'] = response_cache.stats()
+
+    return stats
+
+
 @app.get("/stat/{start}/{end}")
-async def get_stat_month(start: datetime.date, end: datetime.date):
+async def get_stat_month(start: datetime.date, end: datetime.date, request: Request):
     try:
-        machine_1_res = await Database(db_1_path).get_by_duration(start, end)
-        machine_2_res = await Database(db_2_path).get_by_duration(start, end)
+        async def load():
+            machine_1_res = await Database(db_1_path).get_by_duration(start, end)
+            machine_2_res = await Database(db_2_path).get_by_duration(start, end)
+            if machine_1_res is None or machine_2_res is None:
+                raise ValueError('stat query failed')
 
-        return {'machine_1': machine_1_res,
-                'machine_2': machine_2_res}
+            return {'machine_1': machine_1_res,
+                    'machine_2': machine_2_res}
+
+        entry = await response_cache.get('stat', start, end, load)
+        return cached_response(entry, request)
     except Exception as error:
         print(error)
 
 
 @app.get("/stat/{date}")
-async def get_stat_day(date: datetime.date):
+async def get_stat_day(date: datetime.date, request: Request):
     try:
-        machine_1_res = await Database(db_1_path).get_by_one_day(date)
-        machine_2_res = await Database(db_2_path).get_by_one_day(date)
+        async def load():
+            machine_1_res = await Database(db_1_path).get_by_one_day(date)
+            machine_2_res = await Database(db_2_path).get_by_one_day(date)
+            if machine_1_res is None or machine_2_res is None:
+                raise ValueError('stat query failed')
+
+            return {'machine_1': machine_1_res,
+                    'machine_2': machine_2_res}
 
-        return {'machine_1': machine_1_res,
-                'machine_2': machine_2_res}
+        entry = await response_cache.get('stat_day', date, date, load)
+        return cached_response(entry, request)
     except Exception as error:
         print(error)
 
 
 @app.get("/anomaly/{date}")
-async def get_anomaly_day(date: datetime.date):
+async def get_anomaly_day(date: datetime.date, request: Request):
     try:
-        res = await AnomalyDatabase(anomaly_data_db_path).get_by_one_day(date)
+        async def load():
+            res = await AnomalyDatabase(anomaly_data_db_path).get_by_one_day(date)
+            if res is None:
+                raise ValueError('anomaly query failed')
 
-        return res
+            return res
+
+        entry = await response_cache.get('anomaly', date, date, load)
+        return cached_response(entry, request)
     except Exception as error:
         print(error)
 
 
+@app.get("/export/stat/{name}")
+async def export_stat(name: str, start: datetime.date = None, end: datetime.date = None,
+                      table: str = 'hour', fmt: str = 'ndjson'):
+    db_paths = {'machine1': db_1_path, 'machine2': db_2_path}
+    tables = {'hour': 'hour_avr', 'day': 'day_avr'}
+
+    if name not in db_paths or table not in tables or fmt not in export.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail='invalid machine, table or fmt')
+
+    chunks = Database(db_paths[name]).stream(tables[table], start, end, export_chunk_size)
+    return StreamingResponse(export.encode(fmt, export.STAT_COLUMNS, chunks, serializer.dumps),
+                             media_type=export.MEDIA_TYPES[fmt])
+
+
+@app.get("/export/anomaly")
+async def export_anomaly(name: str = None, start: datetime.date = None, end: datetime.date = None,
+                         min_score: float = None, fmt: str = 'ndjson'):
+    if fmt not in export.MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail='invalid fmt')
+
+    chunks = AnomalyDatabase(anomaly_data_db_path).stream(name, start, end, min_score, export_chunk_size)
+    return StreamingResponse(export.encode(fmt, export.ANOMALY_COLUMNS, chunks, serializer.dumps),
+                             media_type=export.MEDIA_TYPES[fmt])
+
+
 if __name__ == "__main__":
     socket_app = socketio.ASGIApp(sio, app)
     main_loop = asyncio.get_event_loop()
+
+    if slow_callback_threshold > 0:
+        install_slow_callback_detector(slow_callback_threshold, socket_logger)
     socket_server = server_load(socket_app, conf, main_loop)
 
+    if lazy_startup:
+        main_loop.create_task(start_components())
+    else:
+        main_loop.run_until_complete(start_components())
+
+    main_loop.create_task(record_bind(socket_server))
     main_loop.run_until_complete(socket_server.serve())
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from datetime import date
+from email.utils import formatdate
+from typing import Callable, Awaitable, Any
+
+from fastapi import Request, Response
+
+
+class CacheEntry:
+    def __init__(self, body: bytes, expires: float = None):
+        self.body = body
+        self.etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.expires = expires
+
+    def is_fresh(self) -> bool:
+        return self.expires is None or self.expires > time.monotonic()
+
+
+class ResponseCache:
+    '''
+        LRU cache of encoded route results keyed by (route, start, end).
+
+        Entries whose period ended before today never expire, others live for
+        ttl seconds and are dropped as soon as invalidate() reports a write for
+        a date inside their period. Concurrent misses for the same key share
+        one query.
+    '''
+    def __init__(self, encoder: Callable[[Any], bytes], max_size: int = 256, ttl: float = 60.0):
+        self.encoder = encoder
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, route: str, start: date, end: date,
+                  loader: Callable[[], Awaitable[Any]]) -> CacheEntry:
+        key = (route, start, end)
+
+        entry = self.entries.get(key)
+        if entry is not None and entry.is_fresh():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+        if key in self.pending:
+            self.hits += 1
+            return await asyncio.shield(self.pending[key])
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        generation = self.generation
+
+        try:
+            entry = self._make_entry(end, await loader())
+            if generation == self.generation:
+                self._store(key, entry)
+
+            future.set_result(entry)
+            return entry
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            # also resolve the shared future when the loading task is cancelled,
+            # otherwise every waiter on it would hang
+            if not future.done():
+                future.set_exception(RuntimeError('cache load cancelled'))
+            future.exception()
+            del self.pending[key]
+
+    def _make_entry(self, end: date, result) -> CacheEntry:
+        if end < date.today():
+            expires = None
+        else:
+            expires = time.monotonic() + self.ttl
+
+        return CacheEntry(self.encoder(result), expires)
+
+    def _store(self, key: tuple, entry: CacheEntry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, route: str, day: date):
+        self.generation += 1
+
+        for key in list(self.entries):
+            _route, start, end = key
+            if _route == route and start <= day <= end:
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+def cached_response(entry: CacheEntry, request: Request) -> Response:
+    headers = {'ETag': entry.etag,
+               'Last-Modified': entry.last_modified,
+               'Cache-Control': 'no-cache'}
+
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
+        if '*' in tags or entry.etag in tags:
+            return Response(status_code=304, headers=headers)
+
+    return Response(content=entry.body, media_type='application/json', headers=headers)
@@ -0,0 +1,64 @@
+import json
+from datetime import date, datetime
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKENDS = ('auto', 'orjson', 'json')
+
+
+def _default(obj):
+    # numpy arrays and scalars without importing numpy
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+
+    raise TypeError('Object of type ' + type(obj).__name__ + ' is not JSON serializable')
+
+
+class JsonSerializer:
+    '''
+        json module replacement for socketio.AsyncServer(json=...) and FastAPI
+        responses. Uses orjson when it is installed (or requested) and the json
+        module otherwise; both encode numpy arrays and scalars.
+    '''
+    def __init__(self, backend: str = 'auto'):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown serializer: ' + backend)
+
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'json'
+        elif backend == 'orjson' and orjson is None:
+            raise ImportError('orjson is not installed')
+
+        self.backend = backend
+
+    def dumps_bytes(self, obj) -> bytes:
+        if self.backend == 'orjson':
+            return orjson.dumps(obj, default=_default,
+                                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+        return json.dumps(obj, default=_default, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if self.backend == 'orjson':
+            return orjson.loads(s)
+
+        return json.loads(s)
+
+
+def response_class(serializer: JsonSerializer):
+    class SerializerJSONResponse(JSONResponse):
+        def render(self, content) -> bytes:
+            return serializer.dumps_bytes(content)
+
+    return SerializerJSONResponse
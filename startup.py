@@ -0,0 +1,65 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Awaitable
+
+
+class StartupTracker:
+    def __init__(self, buffer_size: int = 10000):
+        self.logger = None
+        self.phases = {}
+        self.ready = False
+        self.error = None
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.dropped = 0
+
+    def set_logger(self, logger):
+        self.logger = logger
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = round(seconds, 4)
+        message = 'startup phase ' + name + ' took ' + format(seconds, '.3f') + 's'
+
+        if self.logger is None:
+            print(message)
+        else:
+            self.logger.info(message)
+
+    def fail(self, error: Exception):
+        self.error = str(error)
+
+    def buffer_event(self, event: str, message: dict):
+        if len(self.buffer) >= self.buffer_size:
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append((event, message))
+
+    async def drain(self, handler: Callable[[str, dict], Awaitable[None]]):
+        '''
+            Replay buffered events in arrival order. Events that arrive while
+            replaying are appended to the buffer, so ready is only set once
+            it is empty.
+        '''
+        while self.buffer:
+            event, message = self.buffer.popleft()
+            try:
+                await handler(event, message)
+            except Exception as error:
+                print(error)
+        self.ready = True
+
+    def status(self) -> dict:
+        return {'ready': self.ready,
+                'error': self.error,
+                'buffered': len(self.buffer),
+                'dropped': self.dropped,
+                'phases': self.phases}